@@ -10,6 +10,8 @@ Espone la funzione:
 - `session` è una requests.Session riutilizzabile.
 - `authenticate(session)` esegue il login al portale (se necessario),
   gestendo CSRF e cookie, e solleva un'eccezione se il login fallisce.
+  `authenticate(session, force=True)` rifà il login anche se già eseguito
+  (es. sessione scaduta lato portale).
 
 Pensato per essere compatibile con:
 
@@ -24,8 +26,11 @@ from __future__ import annotations
 
 from typing import Dict, Tuple
 import os
+import re
 import requests
-from html.parser import HTMLParser
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from lxml import etree, html as lxml_html
 
 
 # ============================
@@ -42,34 +47,45 @@ LOGIN_POST_URL = "https://hub.fordtrucks.it/index.php/component/sppagebuilder/"
 USERNAME_FIELD = "username"
 PASSWORD_FIELD = "password"
 
+# Campi hidden del form di login effettivamente richiesti da Joomla,
+# più il token CSRF (nome = 32 caratteri hex, cambia a ogni sessione).
+# Gli altri hidden (tracking, captcha, ecc.) non vengono inoltrati.
+LOGIN_HIDDEN_FIELDS = frozenset({"option", "task", "return"})
+CSRF_TOKEN_RE = re.compile(r"^[a-f0-9]{32}$")
+
 # User-Agent "normale" per evitare blocchi banali
 DEFAULT_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"
 
+# Accept usato per le pagine HTML del portale
+HTML_ACCEPT = "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8"
+
+# Pool di connessioni keep-alive verso il portale: dimensionato per le
+# /verifica concorrenti, così non si riaprono TCP+TLS a ogni chiamata
+POOL_CONNECTIONS = 32
+POOL_MAXSIZE = 64
+
 
 # ============================
-# Parser HTML per hidden fields
+# Estrazione hidden fields
 # ============================
 
-class HiddenInputsParser(HTMLParser):
-    """
-    Parser HTML minimale per recuperare tutti gli <input type="hidden" name="..." value="...">
-    dalla pagina di login (token CSRF, return, option, task, ecc.).
+def estrai_hidden_inputs(content: bytes) -> Dict[str, str]:
     """
+    Recupera tutti gli <input type="hidden" name="..." value="..."> da una
+    pagina HTML (token CSRF, return, option, task, ecc.).
 
-    def __init__(self) -> None:
-        super().__init__()
-        self.hidden_inputs: Dict[str, str] = {}
-
-    def handle_starttag(self, tag, attrs):
-        if tag.lower() != "input":
-            return
-        attr_dict = dict(attrs)
-        if attr_dict.get("type") != "hidden":
-            return
-        name = attr_dict.get("name")
-        value = attr_dict.get("value", "")
-        if name:
-            self.hidden_inputs[name] = value
+    Riceve i bytes grezzi della risposta: lxml rileva da solo l'encoding,
+    evitando la decodifica Python di `response.text`.
+    Una pagina vuota (o solo spazi/commenti) non ha campi: dict vuoto.
+    """
+    try:
+        doc = lxml_html.fromstring(content)
+    except etree.ParserError:
+        return {}
+    return {
+        i.get("name"): i.get("value", "")
+        for i in doc.xpath('//input[@type="hidden"][@name]')
+    }
 
 
 # ============================
@@ -114,60 +130,61 @@ def get_auth() -> Tuple[requests.Session, callable]:
     """
 
     session = requests.Session()
+    # Accept-Encoding resta quello di default di requests: "gzip, deflate",
+    # più "br" quando il pacchetto brotli è installato (requirements.txt).
+    # Forzarlo a mano annuncerebbe br anche senza un decoder disponibile.
     session.headers.update(
         {
             "User-Agent": DEFAULT_USER_AGENT,
+            "Accept": HTML_ACCEPT,
         }
     )
 
+    adapter = HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS,
+        pool_maxsize=POOL_MAXSIZE,
+        pool_block=False,
+        # Niente retry sui read timeout: le POST al portale potrebbero essere
+        # già state elaborate e si triplicherebbe l'attesa (3 x timeout).
+        # Errori di connessione e 502/503/504 restano ritentati.
+        max_retries=Retry(
+            total=2,
+            read=0,
+            backoff_factor=0.3,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=["GET", "POST"],
+        ),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
     logged_flag = {"value": False}  # chiusura mutabile per ricordare se abbiamo già loggato
 
-    def authenticate(sess: requests.Session) -> None:
+    def _post_login(
+        sess: requests.Session,
+        hidden_fields: Dict[str, str],
+        creds: Dict[str, str],
+    ) -> bool:
         """
-        Esegue il login sul portale usando la `sess` passata.
-
-        - GET sulla pagina di login per ricavare i campi hidden
-        - POST al LOGIN_POST_URL con:
-            * hidden fields (option, task, return, token CSRF, ecc.)
-            * username / password letti dall'ambiente
-        - Verifica che nei cookie compaia joomla_user_state=logged_in
+        POST al LOGIN_POST_URL con hidden fields + credenziali.
+        Restituisce True se nei cookie compare joomla_user_state=logged_in.
         """
-        if logged_flag["value"]:
-            # Già loggato in questa esecuzione
-            return
-
-        creds = _get_env_credentials()
-
-        # 1) GET pagina di login per recuperare i campi hidden
-        headers_get = {
-            "User-Agent": DEFAULT_USER_AGENT,
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+        # Prepara payload del login: hidden richiesti + username/password
+        form_data: Dict[str, str] = {
+            k: v
+            for k, v in hidden_fields.items()
+            if k in LOGIN_HIDDEN_FIELDS or CSRF_TOKEN_RE.match(k)
         }
-        resp_get = sess.get(LOGIN_PAGE_URL, headers=headers_get, timeout=30)
-        resp_get.raise_for_status()
-
-        parser = HiddenInputsParser()
-        parser.feed(resp_get.text)
-        hidden_fields = parser.hidden_inputs  # es. option, task, return, token, ...
-
-        if not hidden_fields:
-            # Non abbiamo trovato hidden: non è detto sia un errore, ma è sospetto
-            # Non interrompiamo, ma logghiamo una warning se necessario
-            pass
-
-        # 2) Prepara payload del login: hidden + username/password
-        form_data: Dict[str, str] = dict(hidden_fields)
         form_data[USERNAME_FIELD] = creds["username"]
         form_data[PASSWORD_FIELD] = creds["password"]
 
+        # User-Agent e Accept arrivano dagli header della sessione
         headers_post = {
-            "User-Agent": DEFAULT_USER_AGENT,
-            "Accept": headers_get["Accept"],
             "Origin": "https://hub.fordtrucks.it",
             "Referer": LOGIN_PAGE_URL,
         }
 
-        # 3) POST login (requests segue automaticamente il redirect 303)
+        # requests segue automaticamente il redirect 303
         resp_post = sess.post(
             LOGIN_POST_URL,
             headers=headers_post,
@@ -176,9 +193,42 @@ def get_auth() -> Tuple[requests.Session, callable]:
         )
         resp_post.raise_for_status()
 
-        # 4) Verifica: cerchiamo il cookie joomla_user_state=logged_in
-        cookies_str = "; ".join([f"{c.name}={c.value}" for c in sess.cookies])
-        if "joomla_user_state=logged_in" not in cookies_str:
+        # Verifica: lookup diretto del cookie joomla_user_state nel jar
+        return sess.cookies.get("joomla_user_state") == "logged_in"
+
+    def authenticate(sess: requests.Session, force: bool = False) -> None:
+        """
+        Esegue il login sul portale usando la `sess` passata.
+
+        - GET sulla pagina di login per ricavare i campi hidden: il token
+          CSRF di Joomla è legato alla sessione (cookie) che lo ha emesso,
+          quindi va letto a ogni login e non si può riusare da una cache
+        - POST al LOGIN_POST_URL con hidden fields (option, task, return,
+          token CSRF, ecc.) e username / password letti dall'ambiente
+        - Verifica che nei cookie compaia joomla_user_state=logged_in
+
+        Con `force=True` il login viene rifatto anche se già eseguito.
+        """
+        if logged_flag["value"] and not force:
+            # Già loggato in questa esecuzione
+            return
+        logged_flag["value"] = False
+
+        creds = _get_env_credentials()
+
+        # 1) GET pagina di login per recuperare i campi hidden
+        resp_get = sess.get(LOGIN_PAGE_URL, timeout=30)
+        resp_get.raise_for_status()
+
+        hidden_fields = estrai_hidden_inputs(resp_get.content)  # es. option, task, return, token, ...
+
+        if not hidden_fields:
+            # Non abbiamo trovato hidden: non è detto sia un errore, ma è sospetto
+            # Non interrompiamo, ma logghiamo una warning se necessario
+            pass
+
+        # 2) POST login
+        if not _post_login(sess, hidden_fields, creds):
             raise RuntimeError(
                 "Login non riuscito: cookie 'joomla_user_state=logged_in' non trovato. "
                 "Controlla username/password o eventuali cambi nel form di login."
@@ -0,0 +1,724 @@
+"""
+ford_client.py
+--------------
+Client del portale hub.fordtrucks.it per la verifica garanzia.
+
+Gestisce una sola requests.Session per processo (login via auth.get_auth()
+e token CSRF di /garanzie) ed espone le due chiamate AJAX:
+
+    chiamata_anagrafica(telaio, raw=False) -> {"parsed": ..., ["raw": ...]}
+    chiamata_copertura(telaio, raw=False)  -> {"parsed": ..., ["raw_outer": ..., "raw_inner": ...]}
+
+I payload grezzi del portale sono inclusi solo con raw=True (debug).
+
+Entrambe sono sincrone e thread-safe: main.py le esegue nel threadpool.
+Gli errori previsti sono PortaleFordError o quelli elencati in ERRORI_PORTALE;
+con il portale giù (circuito aperto) PortaleNonDisponibile.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Dict, Mapping, Optional, Tuple
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from types import MappingProxyType
+from urllib.parse import quote_plus, urlencode
+
+import orjson
+import requests
+from prometheus_client import Histogram
+from requests.cookies import create_cookie
+
+# auth.py deve essere nella stessa repo
+from auth import CSRF_TOKEN_RE, USERNAME_FIELD, estrai_hidden_inputs, get_auth
+
+
+logger = logging.getLogger(__name__)
+
+
+class PortaleFordError(Exception):
+    """Errore atteso dal portale (login, token CSRF, status non OK, ...)."""
+
+
+# Errori "previsti" di una verifica: il messaggio viene restituito al client
+# come {"success": False, "error": ...}. Qualsiasi altra eccezione è un bug.
+ERRORI_PORTALE = (PortaleFordError, requests.RequestException, orjson.JSONDecodeError)
+
+
+class PortaleNonDisponibile(PortaleFordError):
+    """Circuito aperto: il portale è considerato giù, nessuna chiamata."""
+
+
+# ============================
+# CIRCUIT BREAKER
+# ============================
+
+# Dopo CIRCUITO_MAX_GUASTI guasti consecutivi del portale (errori di rete,
+# timeout, 5xx già ritentati dall'adapter di auth.py) le chiamate falliscono
+# subito con PortaleNonDisponibile per CIRCUITO_RESET secondi, invece di
+# accumulare thread in attesa di un portale che non risponde. Scaduto il
+# tempo passa una sola chiamata di prova: se riesce il circuito si chiude.
+CIRCUITO_MAX_GUASTI = 5
+CIRCUITO_RESET = 30.0  # secondi
+
+CIRCUITO_LOCK = threading.Lock()
+CIRCUITO_GUASTI = 0
+CIRCUITO_APERTO_DA: Optional[float] = None  # time.monotonic() di apertura
+
+
+def _guasto_upstream(exc: BaseException) -> bool:
+    """True se l'errore indica un portale irraggiungibile o in errore 5xx."""
+    if isinstance(exc, requests.HTTPError):
+        return exc.response is None or exc.response.status_code >= 500
+    return isinstance(exc, requests.RequestException)
+
+
+def _circuito_verifica(prova: bool = True) -> None:
+    """
+    Solleva PortaleNonDisponibile se il circuito è aperto. Scaduto
+    CIRCUITO_RESET, con `prova=True` lascia passare questa sola chiamata
+    (le altre restano bloccate per un altro giro); con `prova=False` lascia
+    passare senza occupare il posto della chiamata di prova (login).
+    """
+    global CIRCUITO_APERTO_DA
+
+    with CIRCUITO_LOCK:
+        if CIRCUITO_APERTO_DA is not None:
+            if time.monotonic() - CIRCUITO_APERTO_DA < CIRCUITO_RESET:
+                raise PortaleNonDisponibile("upstream_unavailable")
+            if prova:
+                CIRCUITO_APERTO_DA = time.monotonic()
+
+
+def _circuito_guasto() -> None:
+    """Registra un guasto del portale; al CIRCUITO_MAX_GUASTI-esimo apre il circuito."""
+    global CIRCUITO_GUASTI, CIRCUITO_APERTO_DA
+
+    with CIRCUITO_LOCK:
+        CIRCUITO_GUASTI += 1
+        if CIRCUITO_GUASTI >= CIRCUITO_MAX_GUASTI:
+            CIRCUITO_APERTO_DA = time.monotonic()
+
+
+def _circuito_ok() -> None:
+    """Il portale ha risposto davvero: azzera i guasti e chiude il circuito."""
+    global CIRCUITO_GUASTI, CIRCUITO_APERTO_DA
+
+    with CIRCUITO_LOCK:
+        CIRCUITO_GUASTI = 0
+        CIRCUITO_APERTO_DA = None
+
+
+# ============================
+# METRICHE
+# ============================
+
+# Durata di ogni chiamata al portale, separata tra rete (POST + lettura del
+# corpo, o login + token) e parse JSON: esposta da main.py su /metrics.
+PORTALE_DURATA = Histogram(
+    "portal_call_seconds",
+    "Durata delle chiamate al portale Ford",
+    ["chiamata", "fase"],
+)
+
+
+def _registra_durata(chiamata: str, fase: str, inizio: float) -> float:
+    """Registra nell'istogramma il tempo trascorso da `inizio` e lo restituisce."""
+    durata = time.perf_counter() - inizio
+    PORTALE_DURATA.labels(chiamata, fase).observe(durata)
+    return durata
+
+
+# ============================
+# SESSIONE PORTALE
+# ============================
+
+PORTAL_SESSION = None
+PORTAL_AUTHENTICATE = None
+PORTAL_LOGGED_IN = False
+
+# Cookie di sessione salvati dopo il login: ai riavvii del worker (Render)
+# vengono ricaricati e il login si salta finché il portale li accetta.
+# JSON (mai pickle: /tmp è scrivibile da tutti) con permessi 0600, perché
+# contiene cookie di sessione validi.
+COOKIE_CACHE_PATH = "/tmp/ford_cookies.json"
+PORTAL_COOKIE_DA_DISCO = False
+
+# Serializza login e recupero token CSRF tra i thread del threadpool
+# (RLock: ensure_garanzie_csrf chiama get_portal_session)
+PORTAL_LOCK = threading.RLock()
+
+GARANZIE_TOKEN_NAME: Optional[str] = None
+GARANZIE_TOKEN_VALUE: Optional[str] = None
+
+# (session, token_name, token_value) quando login e token CSRF sono pronti:
+# il percorso veloce di ogni chiamata è un solo controllo su questa tupla.
+PORTAL_READY: Optional[Tuple[Any, str, str]] = None
+
+GARANZIE_URL = "https://hub.fordtrucks.it/index.php/garanzie"
+
+# Header aggiunti una volta alla sessione creata da auth.get_auth()
+# (che imposta già User-Agent e Accept HTML)
+SESSION_HEADERS = {
+    "Origin": "https://hub.fordtrucks.it",
+    "Referer": GARANZIE_URL,
+}
+
+# Scansione diretta dei bytes di /garanzie per il token CSRF:
+# <input type="hidden" name="<32 hex>" value="1">, attributi in qualsiasi
+# ordine (lookahead). Se non trova nulla si ripiega sul parse lxml.
+GARANZIE_TOKEN_RE = re.compile(
+    rb'<input\b(?=[^>]*\btype="hidden")(?=[^>]*\bvalue="1")[^>]*\bname="([0-9a-f]{32})"',
+    re.I,
+)
+
+# Campo username del form di login Joomla: distingue la pagina di login da
+# una qualsiasi altra pagina HTML (errore, manutenzione, ...). Il form di
+# login ha anche lui un token CSRF "da ospite", che GARANZIE_TOKEN_RE
+# troverebbe: va escluso prima.
+LOGIN_FORM_RE = re.compile(
+    rb"""<input\b[^>]*\bname=["']%s["']""" % re.escape(USERNAME_FIELD.encode()),
+    re.I,
+)
+
+
+# Attributi dei cookie salvati su disco: gli altri (rest, rfc2109, ...)
+# non servono a rimandarli al portale.
+COOKIE_CAMPI = ("name", "value", "domain", "path", "expires", "secure")
+
+
+def _salva_cookie(sess) -> None:
+    """Salva su disco i cookie della sessione (scrittura atomica, file 0600)."""
+    cookies = [{k: getattr(c, k) for k in COOKIE_CAMPI} for c in sess.cookies]
+    cartella = os.path.dirname(COOKIE_CACHE_PATH)
+    try:
+        # mkstemp crea il file con O_EXCL e permessi 0600
+        fd, tmp_path = tempfile.mkstemp(dir=cartella, prefix=".ford_cookies.")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(orjson.dumps(cookies))
+            os.replace(tmp_path, COOKIE_CACHE_PATH)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError:
+        pass  # la cache è solo un'ottimizzazione
+
+
+def _carica_cookie(sess) -> bool:
+    """
+    Ricarica nella sessione i cookie salvati da _salva_cookie(), scartando
+    quelli già scaduti. Restituisce True solo se tra questi c'è
+    joomla_user_state=logged_in. Un file di un altro utente, non leggibile
+    o con contenuto inatteso viene ignorato.
+    """
+    try:
+        with open(COOKIE_CACHE_PATH, "rb") as f:
+            if os.fstat(f.fileno()).st_uid != os.getuid():
+                return False
+            salvati = orjson.loads(f.read())
+        cookies = [
+            create_cookie(
+                c["name"],
+                c["value"],
+                domain=c["domain"],
+                path=c["path"],
+                expires=c["expires"],
+                secure=c["secure"],
+            )
+            for c in salvati
+        ]
+    except (OSError, ValueError, TypeError, KeyError):
+        return False
+
+    loggato = False
+    for c in cookies:
+        if c.is_expired():
+            continue
+        sess.cookies.set_cookie(c)
+        if c.name == "joomla_user_state" and c.value == "logged_in":
+            loggato = True
+    return loggato
+
+
+def get_portal_session():
+    """
+    Usa auth.get_auth():
+      - crea una requests.Session
+      - se ci sono cookie salvati da un processo precedente li ricarica
+        e, se tra questi c'è joomla_user_state=logged_in non scaduto,
+        considera la sessione già loggata (se il portale non la riconosce
+        più, ensure_garanzie_csrf() rifà il login)
+      - altrimenti authenticate(session) esegue il login
+    """
+    global PORTAL_SESSION, PORTAL_AUTHENTICATE, PORTAL_LOGGED_IN
+    global PORTAL_COOKIE_DA_DISCO
+
+    if PORTAL_LOGGED_IN:
+        return PORTAL_SESSION
+
+    with PORTAL_LOCK:
+        if PORTAL_SESSION is None or PORTAL_AUTHENTICATE is None:
+            sess, authenticate = get_auth()
+            sess.headers.update(SESSION_HEADERS)
+            PORTAL_SESSION = sess
+            PORTAL_AUTHENTICATE = authenticate
+            if _carica_cookie(sess):
+                PORTAL_COOKIE_DA_DISCO = True
+                PORTAL_LOGGED_IN = True
+
+        if not PORTAL_LOGGED_IN:
+            # force=True: se siamo qui dopo invalida_sessione_portale() il
+            # login va rifatto anche se auth lo considera già eseguito
+            try:
+                PORTAL_AUTHENTICATE(PORTAL_SESSION, force=True)
+            except RuntimeError as e:
+                # credenziali mancanti o login rifiutato (vedi auth.py)
+                raise PortaleFordError(str(e)) from e
+            _salva_cookie(PORTAL_SESSION)
+            PORTAL_COOKIE_DA_DISCO = False
+            PORTAL_LOGGED_IN = True
+
+    return PORTAL_SESSION
+
+
+def _cerca_token_garanzie(
+    session,
+) -> Tuple[Optional[str], Optional[str], Optional[Dict[str, str]]]:
+    """
+    Legge la pagina /garanzie e restituisce (nome, valore, hidden) del
+    token CSRF; nome e valore sono None se il token non c'è, hidden è
+    None se il portale ha risposto con la pagina di login.
+    """
+    # User-Agent e Accept HTML arrivano dagli header della sessione
+    resp = session.get(GARANZIE_URL, timeout=20)
+    resp.raise_for_status()
+
+    if LOGIN_FORM_RE.search(resp.content):
+        # sessione scaduta: il token del form di login non vale per l'AJAX
+        return None, None, None
+
+    m = GARANZIE_TOKEN_RE.search(resp.content)
+    if m:
+        return m.group(1).decode("ascii"), "1", {}
+
+    # bytes a lxml: niente decodifica (e rilevamento charset) di resp.text
+    hidden = estrai_hidden_inputs(resp.content)
+
+    # Heuristica: token Joomla = nome esattamente 32 char hex, value = "1"
+    for name, value in hidden.items():
+        if CSRF_TOKEN_RE.match(name):
+            return name, value or "1", hidden
+
+    return None, None, hidden
+
+
+def ensure_garanzie_csrf():
+    """
+    Dopo il login, legge la pagina /garanzie e recupera
+    il token CSRF di Joomla per le chiamate AJAX di garanzia.
+
+    Cerca un <input type="hidden" name="<32 hex>" value="1">.
+    """
+    global GARANZIE_TOKEN_NAME, GARANZIE_TOKEN_VALUE
+
+    if GARANZIE_TOKEN_NAME and GARANZIE_TOKEN_VALUE:
+        return
+
+    with PORTAL_LOCK:
+        if GARANZIE_TOKEN_NAME and GARANZIE_TOKEN_VALUE:
+            return
+
+        token_name, token_value, hidden = _cerca_token_garanzie(get_portal_session())
+
+        if not token_name and (hidden is None or PORTAL_COOKIE_DA_DISCO):
+            # Sessione scaduta (/garanzie ha risposto con la pagina di login)
+            # o cookie ricaricati da disco non più validi: login vero e
+            # nuovo tentativo.
+            invalida_sessione_portale(None)
+            token_name, token_value, hidden = _cerca_token_garanzie(get_portal_session())
+
+        if not token_name:
+            if hidden is None:
+                raise PortaleFordError(
+                    "Impossibile trovare il token CSRF in /garanzie: il portale "
+                    "risponde con la pagina di login anche dopo il login."
+                )
+            raise PortaleFordError(
+                f"Impossibile trovare il token CSRF in /garanzie. Hidden trovati: {list(hidden.keys())[:10]}"
+            )
+
+        GARANZIE_TOKEN_NAME = token_name
+        GARANZIE_TOKEN_VALUE = token_value
+
+
+def ensure_portal_ready(circuito: bool = True) -> Tuple[Any, str, str]:
+    """
+    Login + token CSRF in un colpo solo. Restituisce
+    (session, token_name, token_value), calcolata una volta e poi servita
+    da PORTAL_READY finché invalida_sessione_portale() non la azzera.
+
+    Con `circuito=False` non controlla il circuit breaker: lo usa
+    _post_portale(), che lo ha già controllato per l'intera chiamata.
+    """
+    global PORTAL_READY
+
+    ready = PORTAL_READY
+    if ready is not None:
+        return ready
+
+    with PORTAL_LOCK:
+        if PORTAL_READY is None:
+            inizio = time.perf_counter()
+            # Il login registra solo i guasti: riuscire a loggarsi non dice
+            # nulla sugli endpoint AJAX, che chiudono il circuito da soli.
+            if circuito:
+                _circuito_verifica(prova=False)
+            try:
+                session = get_portal_session()
+                ensure_garanzie_csrf()
+            except requests.RequestException as exc:
+                if _guasto_upstream(exc):
+                    _circuito_guasto()
+                raise
+            durata = _registra_durata("login", "rete", inizio)
+            logger.info("Portale pronto (login + token CSRF) in %.0f ms", durata * 1000)
+            PORTAL_READY = (session, GARANZIE_TOKEN_NAME, GARANZIE_TOKEN_VALUE)
+        return PORTAL_READY
+
+
+def portal_ready() -> bool:
+    """True se login e token CSRF sono già pronti (nessun I/O necessario)."""
+    return PORTAL_READY is not None
+
+
+# HEAD leggero usato da ping_portale(): niente corpo da scaricare
+PING_URL = "https://hub.fordtrucks.it/"
+
+
+def ping_portale() -> None:
+    """
+    HEAD sulla homepage con i cookie della sessione, solo se già pronta:
+    tiene aperta una connessione keep-alive nel pool e la sessione Joomla
+    attiva tra una verifica e l'altra. Non esegue mai il login.
+    """
+    ready = PORTAL_READY
+    if ready is None:
+        return
+    ready[0].head(PING_URL, timeout=10).close()
+
+
+def invalida_sessione_portale(token_usato: Optional[str]) -> None:
+    """
+    Segna la sessione come scaduta: il prossimo get_portal_session()
+    rifà il login e ensure_garanzie_csrf() rilegge il token.
+
+    `token_usato` è il nome del token CSRF con cui è fallita la chiamata:
+    se nel frattempo un altro thread ha già rifatto il login (token
+    diverso) non si invalida di nuovo.
+    """
+    global PORTAL_LOGGED_IN
+
+    with PORTAL_LOCK:
+        if GARANZIE_TOKEN_NAME != token_usato:
+            return
+        invalida_token_garanzie(token_usato)
+        PORTAL_LOGGED_IN = False
+        if PORTAL_SESSION is not None:
+            PORTAL_SESSION.cookies.clear()
+
+
+def invalida_token_garanzie(token_usato: Optional[str]) -> None:
+    """
+    Come invalida_sessione_portale() ma solo per il token CSRF (Joomla lo
+    ha ruotato): il login resta valido, si rilegge solo /garanzie.
+    """
+    global GARANZIE_TOKEN_NAME, GARANZIE_TOKEN_VALUE, PORTAL_READY
+
+    with PORTAL_LOCK:
+        if GARANZIE_TOKEN_NAME != token_usato:
+            return
+        PORTAL_READY = None
+        GARANZIE_TOKEN_NAME = None
+        GARANZIE_TOKEN_VALUE = None
+
+
+# ============================
+# CHIAMATE AL PORTALE
+# ============================
+
+# Parti costanti di URL, header e form: costruite una volta sola all'import
+# e di sola lettura (MappingProxyType), per ogni chiamata si aggiungono solo
+# telaio e token CSRF al corpo già codificato.
+# Gli header comuni a tutte le richieste (User-Agent, Origin, Referer)
+# stanno in SESSION_HEADERS e vengono impostati una volta sulla sessione:
+# qui solo quelli specifici delle chiamate AJAX.
+
+# option/view/task viaggiano solo nel corpo (ANAGRAFICA_FORM_BASE): Joomla
+# li legge dal form, come già per la chiamata copertura.
+ANAGRAFICA_URL = "https://hub.fordtrucks.it/index.php/index.php"
+
+ANAGRAFICA_HEADERS = MappingProxyType({
+    "Accept": "application/json, text/javascript, */*; q=0.01",
+    "X-Requested-With": "XMLHttpRequest",
+    "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
+})
+
+ANAGRAFICA_FORM_BASE = MappingProxyType({
+    "option": "com_fordtrucks",
+    "view": "warranty",
+    "task": "warranty.getclaimwarrantyinfo",
+})
+
+# Corpo x-www-form-urlencoded già codificato: per chiamata si accodano
+# solo il telaio (quotato) e il token CSRF, senza passare dall'encoder
+# di requests.
+ANAGRAFICA_BODY_PREFIX = urlencode(ANAGRAFICA_FORM_BASE) + "&jform%5Btelaio%5D="
+
+COPERTURA_URL = "https://hub.fordtrucks.it/index.php/index.php"
+
+COPERTURA_HEADERS = MappingProxyType({
+    "Accept": "*/*",
+    "X-Requested-With": "XMLHttpRequest",
+    "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
+})
+
+COPERTURA_FORM_BASE = MappingProxyType({
+    "option": "com_fordtrucks",
+    "view": "warranty",
+    "task": "warranty_telaio_search",
+    "format": "json",
+})
+
+COPERTURA_BODY_PREFIX = urlencode(COPERTURA_FORM_BASE) + "&telaio="
+
+
+# Oltre questa Content-Length il corpo viene letto a blocchi in un unico
+# bytearray invece che accumulato e poi ricopiato (picco di memoria ~1x).
+STREAM_SOGLIA = 32 * 1024
+STREAM_BLOCCO = 64 * 1024
+
+
+def _leggi_corpo(resp) -> bytes:
+    """Corpo della risposta (richiesta fatta con stream=True)."""
+    try:
+        lunghezza = int(resp.headers.get("Content-Length") or 0)
+    except ValueError:
+        lunghezza = 0
+    if lunghezza <= STREAM_SOGLIA:
+        return resp.content
+
+    buf = bytearray()
+    for chunk in resp.iter_content(STREAM_BLOCCO):
+        buf.extend(chunk)
+    return buf
+
+
+# Valori di "status" che il portale usa per OK (bool o stringa)
+STATUS_OK = frozenset({"1", "true", "True"})
+
+
+def _status_ok(status_val: Any) -> bool:
+    return status_val is True or (status_val is not None and str(status_val) in STATUS_OK)
+
+
+# Risposta Joomla quando il token CSRF non è più valido (ruotato)
+INVALID_TOKEN_MARKER = b"Invalid Token"
+
+
+
+def _needs_relogin(resp, corpo: bytes) -> bool:
+    """
+    True se la risposta indica una sessione portale scaduta: 401/403,
+    oppure (solo con status 2xx/3xx) la pagina HTML con il form di login
+    al posto del JSON atteso. Le pagine di errore 4xx/5xx non fanno
+    rifare il login: l'errore emerge da raise_for_status().
+    """
+    if resp.status_code in (401, 403):
+        return True
+    if resp.status_code >= 400:
+        return False
+    return corpo[:512].lstrip()[:1] == b"<" and LOGIN_FORM_RE.search(corpo) is not None
+
+
+# Byte della risposta riportati nell'errore quando il portale non manda JSON
+# (es. pagina di errore Joomla da ~50 KB)
+ANTEPRIMA_MAX = 4096
+
+
+def _leggi_json(corpo: bytes, chiamata: str) -> Dict[str, Any]:
+    """
+    Decodifica il JSON di una risposta del portale. Se non è JSON solleva
+    PortaleFordError con al massimo ANTEPRIMA_MAX byte del corpo, decodificati
+    senza passare da resp.text (niente rilevamento charset); idem se il JSON
+    non è un oggetto (es. [], null).
+    """
+    try:
+        data = orjson.loads(corpo)
+    except orjson.JSONDecodeError:
+        anteprima = bytes(corpo[:ANTEPRIMA_MAX]).decode("utf-8", "replace")
+        troncata = " [troncata]" if len(corpo) > ANTEPRIMA_MAX else ""
+        raise PortaleFordError(
+            f"Portale {chiamata}: risposta non JSON: {anteprima}{troncata}"
+        ) from None
+    if not isinstance(data, dict):
+        raise PortaleFordError(f"Portale {chiamata}: JSON inatteso: {data!r:.200}")
+    return data
+
+
+def _post_portale(
+    url: str,
+    headers: Mapping[str, str],
+    body_prefix: str,
+    telaio: str,
+    chiamata: str,
+) -> bytes:
+    """
+    POST a un endpoint AJAX del portale: corpo = `body_prefix` + telaio
+    quotato + token CSRF. Restituisce il corpo della risposta.
+    Durata e dimensione della risposta finiscono in log e su /metrics
+    con l'etichetta `chiamata`.
+
+    Se la sessione risulta scaduta rifà login + token e ritenta; se il
+    portale risponde "Invalid Token" rilegge prima solo il token, e se
+    anche il token appena letto viene rifiutato (Joomla lo deriva dalla
+    sessione, quindi è scaduta lei) rifà il login. Dopo il login il corpo
+    viene restituito così com'è (e l'errore emerge dal chiamante).
+    """
+    # Il circuito si controlla una volta per chiamata: se questa è la
+    # chiamata di prova, i tentativi successivi (e il login o la rilettura
+    # del token che li precedono) fanno parte della stessa prova.
+    _circuito_verifica()
+
+    token_riletto = False
+    relogin_fatto = False
+    for tentativo in range(3):
+        session, token_name, token_value = PORTAL_READY or ensure_portal_ready(circuito=False)
+
+        # token CSRF dinamico (nome hex e valore "1": niente da quotare)
+        body = f"{body_prefix}{quote_plus(telaio)}&{token_name}={token_value}"
+
+        inizio = time.perf_counter()
+        try:
+            with session.post(
+                url, headers=headers, data=body.encode(), timeout=20, stream=True
+            ) as resp:
+                corpo = _leggi_corpo(resp)
+        except requests.RequestException as exc:
+            if _guasto_upstream(exc):
+                _circuito_guasto()
+            raise
+        durata = _registra_durata(chiamata, "rete", inizio)
+        logger.info(
+            "Portale %s: HTTP %d, %d byte in %.0f ms (tentativo %d)",
+            chiamata, resp.status_code, len(corpo), durata * 1000, tentativo + 1,
+        )
+
+        # 5xx: guasto del portale, prima di qualsiasi decisione di retry
+        if resp.status_code >= 500:
+            _circuito_guasto()
+            resp.raise_for_status()
+
+        # Relogin e rilettura del token non dicono ancora se il portale
+        # risponde: il circuito resta com'è fino al tentativo successivo.
+        if not relogin_fatto:
+            if _needs_relogin(resp, corpo) or (
+                token_riletto and INVALID_TOKEN_MARKER in corpo
+            ):
+                invalida_sessione_portale(token_name)
+                relogin_fatto = True
+                continue
+            if INVALID_TOKEN_MARKER in corpo:
+                invalida_token_garanzie(token_name)
+                token_riletto = True
+                continue
+
+        _circuito_ok()
+        resp.raise_for_status()
+        return corpo
+
+
+def chiamata_anagrafica(telaio: str, raw: bool = False) -> Dict[str, Any]:
+    """
+    Prima chiamata:
+    task=warranty.getclaimwarrantyinfo
+    -> restituisce targa, rag_sociale, P.IVA, indirizzo, paese...
+    """
+    corpo = _post_portale(
+        ANAGRAFICA_URL, ANAGRAFICA_HEADERS, ANAGRAFICA_BODY_PREFIX, telaio, "anagrafica"
+    )
+
+    inizio = time.perf_counter()
+    data = _leggi_json(corpo, "anagrafica")
+
+    # in alcuni casi status può essere "1"/"0" come stringa
+    if not _status_ok(data.get("status")):
+        raise PortaleFordError(f"Portale anagrafica status non OK: {data}")
+
+    payload: Dict[str, Any] = data.get("data") or {}
+
+    cliente_veicolo = {
+        "targa": payload.get("targa"),
+        "telaio": payload.get("telaio"),
+        "rag_sociale": payload.get("rag_sociale"),
+        "piva_prop": payload.get("piva_prop"),
+        "indirizzo": payload.get("indirizzo"),
+        "paese": payload.get("paese"),
+    }
+    _registra_durata("anagrafica", "parse", inizio)
+
+    if raw:
+        return {"parsed": cliente_veicolo, "raw": data}
+    return {"parsed": cliente_veicolo}
+
+
+def chiamata_copertura(telaio: str, raw: bool = False) -> Dict[str, Any]:
+    """
+    Seconda chiamata:
+    task=warranty_telaio_search&format=json
+    -> restituisce struttura con HAS_WARRANTY e WARRANTY_LIST.
+    """
+    corpo = _post_portale(
+        COPERTURA_URL, COPERTURA_HEADERS, COPERTURA_BODY_PREFIX, telaio, "copertura"
+    )
+
+    inizio = time.perf_counter()
+    outer = _leggi_json(corpo, "copertura")
+
+    if not _status_ok(outer.get("status")):
+        # qui vedi subito eventuali "Invalid Token"
+        raise PortaleFordError(f"Portale copertura status non OK: {outer}")
+
+    data = outer.get("data", "")
+    if not data:
+        raise PortaleFordError(f"Copertura: JSON interno vuoto. outer={outer}")
+
+    # "data" è di norma un JSON serializzato in stringa (doppio decode);
+    # se il portale lo restituisce già come oggetto lo si usa così com'è.
+    if isinstance(data, dict):
+        inner = data
+    else:
+        try:
+            inner = orjson.loads(data)
+        except orjson.JSONDecodeError as e:
+            raise PortaleFordError(f"Copertura: JSON interno non valido ({e})") from None
+        if not isinstance(inner, dict):
+            raise PortaleFordError(f"Copertura: JSON interno inatteso: {inner!r:.200}")
+
+    data_section: Dict[str, Any] = inner.get("Data") or {}
+    warranty_list = data_section.get("WARRANTY_LIST") or []
+    first = warranty_list[0] if warranty_list else {}
+
+    result = {
+        "HAS_WARRANTY": data_section.get("HAS_WARRANTY"),
+        **first,
+    }
+    _registra_durata("copertura", "parse", inizio)
+
+    if raw:
+        return {"parsed": result, "raw_outer": outer, "raw_inner": inner}
+    return {"parsed": result}
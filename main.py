@@ -1,17 +1,94 @@
-from fastapi import FastAPI
+from fastapi import Body, FastAPI, Header, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Any, Dict, Optional
-import json
-from html.parser import HTMLParser
-import string
+from fastapi.responses import ORJSONResponse, Response
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import re
+import orjson
+from cachetools import TTLCache
+from prometheus_client import make_asgi_app
+
+from ford_client import (
+    CIRCUITO_RESET,
+    ERRORI_PORTALE,
+    PortaleNonDisponibile,
+    chiamata_anagrafica,
+    chiamata_copertura,
+    ensure_portal_ready,
+    ping_portale,
+    portal_ready,
+)
+
+
+logger = logging.getLogger(__name__)
 
-from auth import get_auth  # auth.py deve essere nella stessa repo
+# Con DEBUG=1 le risposte includono sempre i payload grezzi del portale
+# (blocco "debug"); altrimenti solo su richiesta con ?debug=1.
+DEBUG = os.environ.get("DEBUG") == "1"
+
+# Segreto condiviso per le operazioni di amministrazione (header
+# X-Admin-Token); se non impostato le operazioni sono disabilitate.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
+# ============================
+# AVVIO
+# ============================
+
+# Intervallo del ping al portale: sotto il timeout keep-alive del server,
+# così la connessione nel pool non viene chiusa mentre l'app è inattiva.
+KEEPALIVE_INTERVALLO = 60  # secondi
+
+
+async def keepalive_portale() -> None:
+    """Ping periodico al portale finché l'app è in esecuzione."""
+    while True:
+        await asyncio.sleep(KEEPALIVE_INTERVALLO)
+        try:
+            await run_in_threadpool(ping_portale)
+        except Exception:
+            # un ping perso non è un problema: la prossima verifica
+            # riaprirà la connessione (e rifarà il login se serve)
+            logger.debug("Ping al portale non riuscito", exc_info=True)
+
+
+async def warm_portal() -> None:
+    """
+    Login + token CSRF all'avvio, così il primo /verifica non paga il
+    costo del login. Il GET della pagina di login e quello di /garanzie
+    lasciano anche una connessione TLS pronta nel pool della sessione,
+    che il ping periodico (keepalive_portale) mantiene poi aperta.
+
+    Se il portale non risponde l'app parte comunque: il login verrà
+    ritentato alla prima richiesta.
+    """
+    try:
+        await run_in_threadpool(ensure_portal_ready)
+    except Exception:
+        logger.warning("Login al portale all'avvio non riuscito", exc_info=True)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Avvio: login e ping periodico; arresto: ferma il ping."""
+    await warm_portal()
+    keepalive_task = asyncio.ensure_future(keepalive_portale())
+    try:
+        yield
+    finally:
+        keepalive_task.cancel()
 
 
 app = FastAPI(
     title="Backend verifica garanzia",
     version="6.1.1",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
 # ============================
@@ -30,269 +107,405 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # X-Cache ed ETag leggibili anche dal frontend (fetch cross-origin)
+    expose_headers=["X-Cache", "ETag"],
 )
 
-class VerificaRequest(BaseModel):
-    telaio: str
-
-
 # ============================
-# SESSIONE PORTALE
+# METRICHE
 # ============================
 
-PORTAL_SESSION = None
-PORTAL_AUTHENTICATE = None
-PORTAL_LOGGED_IN = False
+# Formato Prometheus: durate delle chiamate al portale (portal_call_seconds)
+# più le metriche di processo. Con più worker ognuno espone le proprie.
+app.mount("/metrics", make_asgi_app())
 
-GARANZIE_TOKEN_NAME: Optional[str] = None
-GARANZIE_TOKEN_VALUE: Optional[str] = None
-
-GARANZIE_URL = "https://hub.fordtrucks.it/index.php/garanzie"
+# ============================
+# VALIDAZIONE TELAIO
+# ============================
 
+# VIN a 17 caratteri, senza I, O, Q: i telai palesemente errati (refusi,
+# scansioni di bot) vengono respinti prima di qualsiasi chiamata al portale.
+TELAIO_RE = re.compile(r"[A-HJ-NPR-Z0-9]{17}")
 
-class HiddenInputsParser(HTMLParser):
-    """Parser per tutti gli <input type="hidden"> in una pagina HTML."""
 
-    def __init__(self) -> None:
-        super().__init__()
-        self.hidden_inputs: Dict[str, str] = {}
+def errore_telaio(telaio: str) -> Optional[str]:
+    """Messaggio d'errore per un telaio già normalizzato, None se valido."""
+    if not telaio:
+        return "Telaio mancante"
+    if not TELAIO_RE.fullmatch(telaio):
+        return "Telaio non valido"
+    return None
 
-    def handle_starttag(self, tag, attrs):
-        if tag.lower() != "input":
-            return
-        attr_dict = dict(attrs)
-        if attr_dict.get("type") != "hidden":
-          return
-        name = attr_dict.get("name")
-        value = attr_dict.get("value", "")
-        if name:
-            self.hidden_inputs[name] = value
 
+# ============================
+# CACHE VERIFICHE
+# ============================
 
-def get_portal_session():
+# Lo stato garanzia cambia nell'ordine dei giorni: un risultato recente per
+# lo stesso telaio viene servito dalla memoria senza toccare il portale.
+# In cache vanno solo cliente_veicolo/copertura/errors (qualche centinaio di
+# byte); i payload grezzi del blocco "debug" solo con DEBUG=1.
+# Ogni voce è (scadenza, risultato): la scadenza dà il max-age residuo.
+VERIFICA_CACHE_TTL = 10 * 60  # secondi
+VERIFICA_CACHE: TTLCache = TTLCache(maxsize=4096, ttl=VERIFICA_CACHE_TTL)
+
+# Single-flight: richieste concorrenti per lo stesso telaio condividono
+# un'unica coppia di chiamate al portale (le richieste con debug, che
+# vogliono anche i payload grezzi, hanno un volo a parte).
+# Cache e mappa in-flight sono usate solo dal thread dell'event loop,
+# quindi non serve un lock.
+VERIFICHE_IN_CORSO: Dict[str, "asyncio.Task[Dict[str, Any]]"] = {}
+
+
+def _da_cache(key: str, con_raw: bool) -> Optional[Dict[str, Any]]:
+    """Risultato in cache per `key`, None se assente o senza il blocco debug richiesto."""
+    voce = VERIFICA_CACHE.get(key)
+    if voce is None:
+        return None
+    result = voce[1]
+    if con_raw and "debug" not in result:
+        return None
+    return result
+
+
+def max_age_residuo(telaio: str) -> int:
+    """Secondi di validità rimasti alla voce in cache per `telaio` (0 se assente)."""
+    voce = VERIFICA_CACHE.get(telaio.upper())
+    if voce is None:
+        return 0
+    return max(0, int(voce[0] - VERIFICA_CACHE.timer()))
+
+
+async def _verifica_portale(telaio: str, key: str, con_raw: bool) -> Dict[str, Any]:
     """
-    Usa auth.get_auth():
-      - crea una requests.Session
-      - authenticate(session) esegue il login
+    Esegue le due chiamate al portale e salva in cache il risultato; con
+    `con_raw` include anche il blocco "debug" con i payload grezzi.
     """
-    global PORTAL_SESSION, PORTAL_AUTHENTICATE, PORTAL_LOGGED_IN
+    # Login + token CSRF una volta sola (passando dal threadpool solo se non
+    # ancora pronti), poi le due chiamate (indipendenti) partono in parallelo
+    # nel threadpool sulla stessa sessione keep-alive.
+    if not portal_ready():
+        await run_in_threadpool(ensure_portal_ready)
+    cop_task = asyncio.ensure_future(
+        run_in_threadpool(chiamata_copertura, telaio, con_raw)
+    )
+    try:
+        anag = await run_in_threadpool(chiamata_anagrafica, telaio, con_raw)
+    except BaseException:
+        cop_task.cancel()
+        raise
+
+    if not any(anag["parsed"].values()):
+        # Nessun veicolo per questo telaio: la copertura non serve.
+        # La POST già partita nel thread non si può interrompere, ma non la
+        # si aspetta e il risultato negativo non va in cache.
+        cop_task.cancel()
+        return {"success": False, "error": "Telaio non trovato"}
+
+    # Risultato parziale: se fallisce solo la copertura, i dati anagrafici
+    # già ottenuti vengono restituiti comunque, con l'errore in "errors".
+    errors: List[str] = []
+    try:
+        cop: Optional[Dict[str, Any]] = await cop_task
+    except ERRORI_PORTALE as exc:
+        logger.warning("Chiamata copertura fallita per %s: %s", telaio, exc)
+        errors.append(f"copertura: {exc}")
+        cop = None
+
+    result: Dict[str, Any] = {
+        "success": True,
+        "cliente_veicolo": anag["parsed"],
+        "copertura": cop["parsed"] if cop else None,
+        "errors": errors,
+    }
+    if con_raw:
+        result["debug"] = {
+            "anagrafica_raw": anag["raw"],
+            "copertura_outer": cop["raw_outer"] if cop else None,
+            "copertura_inner": cop["raw_inner"] if cop else None,
+        }
 
-    if PORTAL_SESSION is None or PORTAL_AUTHENTICATE is None:
-        sess, authenticate = get_auth()
-        PORTAL_SESSION = sess
-        PORTAL_AUTHENTICATE = authenticate
+    # In cache solo i risultati completi: un parziale si ritenta alla
+    # prossima richiesta.
+    if not errors:
+        da_salvare = result
+        if con_raw and not DEBUG:
+            da_salvare = {k: v for k, v in result.items() if k != "debug"}
+        VERIFICA_CACHE[key] = (VERIFICA_CACHE.timer() + VERIFICA_CACHE_TTL, da_salvare)
+    return result
 
-    if not PORTAL_LOGGED_IN:
-        PORTAL_AUTHENTICATE(PORTAL_SESSION)
-        PORTAL_LOGGED_IN = True
 
-    return PORTAL_SESSION
+def in_cache(telaio: str, debug: bool = False) -> bool:
+    """True se verifica_con_cache(telaio, debug) non dovrà interrogare il portale."""
+    return _da_cache(telaio.upper(), debug or DEBUG) is not None
 
 
-def ensure_garanzie_csrf():
+async def verifica_con_cache(telaio: str, debug: bool = False) -> Dict[str, Any]:
     """
-    Dopo il login, legge la pagina /garanzie e recupera
-    il token CSRF di Joomla per le chiamate AJAX di garanzia.
+    Restituisce il risultato di verifica per `telaio`, dalla cache se
+    ancora valido, altrimenti interrogando il portale (una sola volta anche
+    con più richieste concorrenti per lo stesso telaio).
 
-    Cerca un <input type="hidden" name="<32 hex>" value="1">.
+    Il blocco "debug" (payload grezzi) c'è solo con `debug` o DEBUG=1.
+    Le eccezioni delle chiamate al portale vengono propagate al chiamante.
     """
-    global GARANZIE_TOKEN_NAME, GARANZIE_TOKEN_VALUE
+    key = telaio.upper()
+    con_raw = debug or DEBUG
 
-    if GARANZIE_TOKEN_NAME and GARANZIE_TOKEN_VALUE:
-        return
+    cached = _da_cache(key, con_raw)
+    if cached is not None:
+        return cached
 
-    session = get_portal_session()
+    volo = f"{key}|debug" if con_raw else key
+    task = VERIFICHE_IN_CORSO.get(volo)
+    if task is None:
+        task = asyncio.ensure_future(_verifica_portale(telaio, key, con_raw))
+        VERIFICHE_IN_CORSO[volo] = task
+        task.add_done_callback(lambda _t: VERIFICHE_IN_CORSO.pop(volo, None))
 
-    resp = session.get(
-        GARANZIE_URL,
-        headers={
-            "User-Agent": "Mozilla/5.0",
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-        },
-        timeout=20,
-    )
-    resp.raise_for_status()
-
-    parser = HiddenInputsParser()
-    parser.feed(resp.text)
-    hidden = parser.hidden_inputs
-
-    # Heuristica: token Joomla = nome esattamente 32 char hex, value = "1"
-    token_name = None
-    token_value = None
-    for name, value in hidden.items():
-        if len(name) == 32 and all(c in string.hexdigits for c in name):
-            token_name = name
-            token_value = value or "1"
-            break
-
-    if not token_name:
-        raise RuntimeError(
-            f"Impossibile trovare il token CSRF in /garanzie. Hidden trovati: {list(hidden.keys())[:10]}"
-        )
+    # shield: se un client si disconnette, la chiamata condivisa prosegue
+    # per gli altri in attesa.
+    return await asyncio.shield(task)
 
-    GARANZIE_TOKEN_NAME = token_name
-    GARANZIE_TOKEN_VALUE = token_value
 
+def risultato_completo(result: Dict[str, Any]) -> bool:
+    """True se la verifica è riuscita senza errori parziali (cacheabile)."""
+    return bool(result.get("success")) and not result.get("errors")
 
-# ============================
-# CHIAMATE AL PORTALE
-# ============================
 
-def chiamata_anagrafica(telaio: str) -> Dict[str, Any]:
-    """
-    Prima chiamata:
-    task=warranty.getclaimwarrantyinfo
-    -> restituisce targa, rag_sociale, P.IVA, indirizzo, paese...
+# Massimo numero di verifiche di un batch in corso contemporaneamente
+BATCH_CONCORRENZA = 8
+
+# Massimo numero di telai per richiesta batch: l'endpoint non è autenticato
+# e ogni telaio nuovo costa due chiamate al portale con l'account aziendale
+BATCH_MAX_TELAI = int(os.environ.get("BATCH_MAX_TELAI", "50"))
+
+
+async def verifica_batch(
+    telai: List[str],
+    debug: bool = False,
+    total_timeout: Optional[float] = None,
+) -> List[Dict[str, Any]]:
     """
-    session = get_portal_session()
-    ensure_garanzie_csrf()
-
-    url = (
-        "https://hub.fordtrucks.it/index.php/index.php"
-        "?option=com_fordtrucks"
-        "&view=warranty"
-        "&task=warranty.getclaimwarrantyinfo"
-    )
+    Verifica più telai in parallelo (al massimo BATCH_CONCORRENZA alla
+    volta), passando dalla cache: i duplicati costano una sola chiamata.
 
-    headers = {
-        "User-Agent": "Mozilla/5.0",
-        "Accept": "application/json, text/javascript, */*; q=0.01",
-        "X-Requested-With": "XMLHttpRequest",
-        "Origin": "https://hub.fordtrucks.it",
-        "Referer": GARANZIE_URL,
-    }
+    Ogni elemento ha la stessa forma della risposta di /verifica; un errore
+    su un telaio non interrompe gli altri. Con `total_timeout` (secondi) i
+    telai non ancora verificati allo scadere tornano come errore "Timeout",
+    gli altri con il loro risultato.
+    """
+    sem = asyncio.Semaphore(BATCH_CONCORRENZA)
 
-    form_data = {
-        "option": "com_fordtrucks",
-        "view": "warranty",
-        "task": "warranty.getclaimwarrantyinfo",
-        "jform[telaio]": telaio,
-    }
+    async def una(telaio: str) -> Dict[str, Any]:
+        telaio = telaio.strip().upper()
+        errore = errore_telaio(telaio)
+        if errore:
+            return {"success": False, "error": errore}
+        async with sem:
+            return await verifica_con_cache(telaio, debug)
 
-    # aggiungi token CSRF dinamico
-    if GARANZIE_TOKEN_NAME and GARANZIE_TOKEN_VALUE:
-        form_data[GARANZIE_TOKEN_NAME] = GARANZIE_TOKEN_VALUE
+    if not telai:
+        return []
 
-    resp = session.post(url, headers=headers, data=form_data, timeout=20)
-    resp.raise_for_status()
+    tasks = [asyncio.ensure_future(una(t)) for t in telai]
+    try:
+        _, in_sospeso = await asyncio.wait(tasks, timeout=total_timeout)
+    finally:
+        # Scaduto il timeout (o disconnesso il client) le verifiche rimaste
+        # si abbandonano; quelle condivise proseguono grazie allo shield.
+        for t in tasks:
+            t.cancel()
+
+    risultati: List[Dict[str, Any]] = []
+    for t in tasks:
+        if t in in_sospeso:
+            risultati.append({"success": False, "error": "Timeout"})
+        elif isinstance(t.exception(), ERRORI_PORTALE):
+            risultati.append({"success": False, "error": str(t.exception())})
+        elif t.exception() is not None:
+            # qualsiasi altra eccezione è un bug: nel log, non al client
+            logger.error(
+                "Errore inatteso nella verifica batch", exc_info=t.exception()
+            )
+            risultati.append({"success": False, "error": "Errore interno"})
+        else:
+            risultati.append(t.result())
+    return risultati
 
-    data = resp.json()
 
-    # in alcuni casi status può essere "1"/"0" come stringa
-    status_val = data.get("status")
-    if not status_val or str(status_val) not in ("1", "true", "True", True):
-        raise RuntimeError(f"Portale anagrafica status non OK: {data}")
+# ============================
+# GESTIONE ERRORI
+# ============================
 
-    payload: Dict[str, Any] = data.get("data") or {}
+async def errore_portale(request: Request, exc: Exception) -> ORJSONResponse:
+    """
+    Errori previsti del portale: stessa forma di risposta di sempre
+    ({"success": False, "error": ...}, HTTP 200) per il frontend.
+    Le altre eccezioni restano 500 tramite l'handler di FastAPI.
+    """
+    return ORJSONResponse({"success": False, "error": str(exc)})
 
-    cliente_veicolo = {
-        "targa": payload.get("targa"),
-        "telaio": payload.get("telaio"),
-        "rag_sociale": payload.get("rag_sociale"),
-        "piva_prop": payload.get("piva_prop"),
-        "indirizzo": payload.get("indirizzo"),
-        "paese": payload.get("paese"),
-    }
 
-    return {
-        "parsed": cliente_veicolo,
-        "raw": data,
-    }
+for _exc_type in ERRORI_PORTALE:
+    app.add_exception_handler(_exc_type, errore_portale)
 
 
-def chiamata_copertura(telaio: str) -> Dict[str, Any]:
+@app.exception_handler(PortaleNonDisponibile)
+async def portale_non_disponibile(request: Request, exc: Exception) -> ORJSONResponse:
     """
-    Seconda chiamata:
-    task=warranty_telaio_search&format=json
-    -> restituisce struttura con HAS_WARRANTY e WARRANTY_LIST.
+    Circuito aperto verso il portale: risposta immediata 503, così il
+    client può distinguere il portale giù da un errore sul telaio.
     """
-    session = get_portal_session()
-    ensure_garanzie_csrf()
-
-    url = "https://hub.fordtrucks.it/index.php/index.php"
-
-    headers = {
-        "User-Agent": "Mozilla/5.0",
-        "Accept": "*/*",
-        "X-Requested-With": "XMLHttpRequest",
-        "Origin": "https://hub.fordtrucks.it",
-        "Referer": GARANZIE_URL,
-        "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
-    }
+    return ORJSONResponse(
+        {"success": False, "error": "upstream_unavailable"},
+        status_code=503,
+        headers={"Retry-After": str(int(CIRCUITO_RESET))},
+    )
 
-    form_data = {
-        "option": "com_fordtrucks",
-        "view": "warranty",
-        "task": "warranty_telaio_search",
-        "format": "json",
-        "telaio": telaio,
-    }
 
-    # token CSRF dinamico
-    if GARANZIE_TOKEN_NAME and GARANZIE_TOKEN_VALUE:
-        form_data[GARANZIE_TOKEN_NAME] = GARANZIE_TOKEN_VALUE
+# ============================
+# ENDPOINTS FASTAPI
+# ============================
 
-    resp = session.post(url, headers=headers, data=form_data, timeout=20)
-    resp.raise_for_status()
+@app.post("/verifica")
+async def verifica_garanzia(request: Request, debug: bool = False) -> ORJSONResponse:
+    # Body {"telaio": "..."} letto a mano: per un solo campo stringa il
+    # modello pydantic costava più della verifica stessa.
+    try:
+        body = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        return ORJSONResponse(
+            {"success": False, "error": "JSON non valido"}, status_code=400
+        )
 
-    outer = resp.json()
+    if not isinstance(body, dict):
+        body = {}
+    telaio = body.get("telaio")
+    telaio = telaio.strip().upper() if isinstance(telaio, str) else ""
+    # debug accettato sia come ?debug=1 sia come {"debug": true} nel body
+    debug = debug or body.get("debug") is True
+
+    errore = errore_telaio(telaio)
+    if errore:
+        return ORJSONResponse({"success": False, "error": errore})
+
+    # Controllato prima della chiamata: verifica_con_cache legge la cache
+    # senza cedere il loop, quindi l'esito non cambia nel frattempo.
+    hit = in_cache(telaio, debug)
+    result = await verifica_con_cache(telaio, debug)
+
+    # Cacheabile lato client solo un risultato completo senza debug (payload
+    # grezzi del portale), solo dal browser ("private": dati del cliente) e
+    # solo per il tempo che resta alla voce nella cache in memoria.
+    max_age = 0
+    if not (debug or DEBUG) and risultato_completo(result):
+        max_age = max_age_residuo(telaio)
+
+    # ORJSONResponse diretto: niente passaggio da jsonable_encoder
+    return ORJSONResponse(
+        result,
+        headers={
+            "X-Cache": "HIT" if hit else "MISS",
+            "Cache-Control": f"private, max-age={max_age}" if max_age else "no-store",
+        },
+    )
 
-    status_val = outer.get("status")
-    if not status_val or str(status_val) not in ("1", "true", "True", True):
-        # qui vedi subito eventuali "Invalid Token"
-        raise RuntimeError(f"Portale copertura status non OK: {outer}")
 
-    data_str = outer.get("data", "")
-    if not data_str:
-        raise RuntimeError(f"Copertura: JSON interno vuoto. outer={outer}")
+# Cache HTTP per la variante GET: il browser può riusare la risposta senza
+# arrivare al processo. "private": il corpo contiene dati del cliente
+# (ragione sociale, P.IVA, indirizzo) su un URL non autenticato, quindi
+# niente CDN né proxy condivisi. max-age mai oltre la vita residua della
+# voce nella cache in memoria.
+VERIFICA_GET_MAX_AGE = 300  # secondi
+VERIFICA_GET_STALE = 60  # secondi
 
-    inner = json.loads(data_str)
 
-    data_section: Dict[str, Any] = inner.get("Data") or {}
-    warranty_list = data_section.get("WARRANTY_LIST") or []
-    first = warranty_list[0] if warranty_list else {}
+def _etag_corrisponde(if_none_match: Optional[str], etag: str) -> bool:
+    """Confronto debole di If-None-Match (lista separata da virgole, W/...)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        t.strip().removeprefix("W/") == etag for t in if_none_match.split(",")
+    )
 
-    result = {
-        "HAS_WARRANTY": data_section.get("HAS_WARRANTY"),
-        **first,
-    }
 
-    return {
-        "parsed": result,
-        "raw_outer": outer,
-        "raw_inner": inner,
-    }
+@app.get("/verifica/{telaio}")
+async def verifica_garanzia_get(
+    telaio: str, request: Request, debug: bool = False
+) -> Response:
+    """
+    Come POST /verifica ma cacheabile dal browser: Cache-Control privato ed
+    ETag sul corpo; con If-None-Match corrispondente risponde 304 senza
+    corpo. Errori, risultati parziali e risposte con debug (payload grezzi
+    del portale) non sono cacheabili.
+    """
+    telaio = telaio.strip().upper()
+    errore = errore_telaio(telaio)
+    if errore:
+        return ORJSONResponse(
+            {"success": False, "error": errore}, headers={"Cache-Control": "no-store"}
+        )
 
+    hit = in_cache(telaio, debug)
+    result = await verifica_con_cache(telaio, debug)
+    headers = {"X-Cache": "HIT" if hit else "MISS"}
 
-# ============================
-# ENDPOINTS FASTAPI
-# ============================
+    corpo = orjson.dumps(result)
+    max_age = min(VERIFICA_GET_MAX_AGE, max_age_residuo(telaio))
+    if debug or DEBUG or not risultato_completo(result) or not max_age:
+        headers["Cache-Control"] = "no-store"
+        return Response(corpo, media_type="application/json", headers=headers)
 
-@app.post("/verifica")
-def verifica_garanzia(request: VerificaRequest) -> Dict[str, Any]:
-    telaio = request.telaio.strip()
+    etag = f'"{hashlib.blake2b(corpo, digest_size=8).hexdigest()}"'
+    headers["Cache-Control"] = (
+        f"private, max-age={max_age}, stale-while-revalidate={VERIFICA_GET_STALE}"
+    )
+    headers["ETag"] = etag
+    if _etag_corrisponde(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(corpo, media_type="application/json", headers=headers)
+
+
+@app.post("/verifica/batch")
+@app.post("/verifica_batch")
+async def verifica_garanzia_batch(
+    telai: List[str] = Body(..., embed=True, max_length=BATCH_MAX_TELAI),
+    total_timeout: Optional[float] = Body(None, embed=True, gt=0),
+    debug: bool = False,
+) -> ORJSONResponse:
+    """
+    Body {"telai": ["...", ...], "total_timeout": 20} -> lista di risultati
+    nello stesso ordine. `total_timeout` (secondi) è facoltativo; oltre
+    BATCH_MAX_TELAI telai la richiesta è respinta con 422.
+    """
+    return ORJSONResponse(await verifica_batch(telai, debug, total_timeout))
 
-    if not telaio:
-        return {"success": False, "error": "Telaio mancante"}
 
-    try:
-        anag = chiamata_anagrafica(telaio)
-        cop = chiamata_copertura(telaio)
-
-        return {
-            "success": True,
-            "cliente_veicolo": anag["parsed"],
-            "copertura": cop["parsed"],
-            "debug": {
-                "anagrafica_raw": anag["raw"],
-                "copertura_outer": cop["raw_outer"],
-                "copertura_inner": cop["raw_inner"],
-            },
-        }
+@app.delete("/verifica/cache")
+async def svuota_cache_verifiche(
+    telaio: Optional[str] = None,
+    x_admin_token: Optional[str] = Header(None),
+) -> ORJSONResponse:
+    """
+    Invalida la cache delle verifiche: solo `?telaio=...` se indicato,
+    altrimenti tutta. Richiede l'header X-Admin-Token uguale ad ADMIN_TOKEN.
+    """
+    if not ADMIN_TOKEN or not hmac.compare_digest(
+        (x_admin_token or "").encode(), ADMIN_TOKEN.encode()
+    ):
+        return ORJSONResponse(
+            {"success": False, "error": "Non autorizzato"}, status_code=403
+        )
 
-    except Exception as e:
-        return {"success": False, "error": str(e)}
+    if telaio:
+        rimossi = 1 if VERIFICA_CACHE.pop(telaio.strip().upper(), None) is not None else 0
+    else:
+        rimossi = len(VERIFICA_CACHE)
+        VERIFICA_CACHE.clear()
+    return ORJSONResponse({"success": True, "rimossi": rimossi})
 
 
 @app.get("/")